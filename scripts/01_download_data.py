@@ -4,208 +4,112 @@ Downloads all required NHANES data files (1988-2023) for CHD prevalence analysis
 """
 
 import os
+import json
+import argparse
+import ssl
+import shutil
 import pandas as pd
 from pathlib import Path
-import urllib.request
-import ssl
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
-# Disable SSL verification for CDC downloads (some environments have issues)
-ssl._create_default_https_context = ssl._create_unverified_context
+# Disable SSL warnings (verification is off for CDC downloads - some environments have issues)
+import urllib3
+urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
 # Project paths
 PROJECT_ROOT = Path(__file__).parent.parent
 DATA_RAW = PROJECT_ROOT / "data" / "raw"
 
-# NHANES data file URLs organized by cycle and component
-NHANES_FILES = {
-    # === Era 4b: 2021-2023 (Post-Pandemic) ===
-    "2021-2023": {
-        "DEMO": "https://wwwn.cdc.gov/Nchs/Data/Nhanes/Public/2021/DataFiles/DEMO_L.xpt",
-        "MCQ": "https://wwwn.cdc.gov/Nchs/Data/Nhanes/Public/2021/DataFiles/MCQ_L.xpt",
-        "BPQ": "https://wwwn.cdc.gov/Nchs/Data/Nhanes/Public/2021/DataFiles/BPQ_L.xpt",
-        "DIQ": "https://wwwn.cdc.gov/Nchs/Data/Nhanes/Public/2021/DataFiles/DIQ_L.xpt",
-        "SMQ": "https://wwwn.cdc.gov/Nchs/Data/Nhanes/Public/2021/DataFiles/SMQ_L.xpt",
-        "PAQ": "https://wwwn.cdc.gov/Nchs/Data/Nhanes/Public/2021/DataFiles/PAQ_L.xpt",
-        "BMX": "https://wwwn.cdc.gov/Nchs/Data/Nhanes/Public/2021/DataFiles/BMX_L.xpt",
-        "BPX": "https://wwwn.cdc.gov/Nchs/Data/Nhanes/Public/2021/DataFiles/BPXO_L.xpt",
-        "GHB": "https://wwwn.cdc.gov/Nchs/Data/Nhanes/Public/2021/DataFiles/GHB_L.xpt",
-        "GLU": "https://wwwn.cdc.gov/Nchs/Data/Nhanes/Public/2021/DataFiles/GLU_L.xpt",
-        "TCHOL": "https://wwwn.cdc.gov/Nchs/Data/Nhanes/Public/2021/DataFiles/TCHOL_L.xpt",
-        "HDL": "https://wwwn.cdc.gov/Nchs/Data/Nhanes/Public/2021/DataFiles/HDL_L.xpt",
-        "TRIGLY": "https://wwwn.cdc.gov/Nchs/Data/Nhanes/Public/2021/DataFiles/TRIGLY_L.xpt",
-    },
-    
-    # === Era 4a: 2017-2020 Pre-Pandemic ===
-    "2017-2020": {
-        "DEMO": "https://wwwn.cdc.gov/Nchs/Data/Nhanes/Public/2017/DataFiles/P_DEMO.xpt",
-        "MCQ": "https://wwwn.cdc.gov/Nchs/Data/Nhanes/Public/2017/DataFiles/P_MCQ.xpt",
-        "BPQ": "https://wwwn.cdc.gov/Nchs/Data/Nhanes/Public/2017/DataFiles/P_BPQ.xpt",
-        "DIQ": "https://wwwn.cdc.gov/Nchs/Data/Nhanes/Public/2017/DataFiles/P_DIQ.xpt",
-        "SMQ": "https://wwwn.cdc.gov/Nchs/Data/Nhanes/Public/2017/DataFiles/P_SMQ.xpt",
-        "PAQ": "https://wwwn.cdc.gov/Nchs/Data/Nhanes/Public/2017/DataFiles/P_PAQ.xpt",
-        "BMX": "https://wwwn.cdc.gov/Nchs/Data/Nhanes/Public/2017/DataFiles/P_BMX.xpt",
-        "BPX": "https://wwwn.cdc.gov/Nchs/Data/Nhanes/Public/2017/DataFiles/P_BPXO.xpt",
-        "GHB": "https://wwwn.cdc.gov/Nchs/Data/Nhanes/Public/2017/DataFiles/P_GHB.xpt",
-        "GLU": "https://wwwn.cdc.gov/Nchs/Data/Nhanes/Public/2017/DataFiles/P_GLU.xpt",
-        "TCHOL": "https://wwwn.cdc.gov/Nchs/Data/Nhanes/Public/2017/DataFiles/P_TCHOL.xpt",
-        "HDL": "https://wwwn.cdc.gov/Nchs/Data/Nhanes/Public/2017/DataFiles/P_HDL.xpt",
-        "TRIGLY": "https://wwwn.cdc.gov/Nchs/Data/Nhanes/Public/2017/DataFiles/P_TRIGLY.xpt",
-    },
-    
-    # === Era 4a: 2015-2016 ===
-    "2015-2016": {
-        "DEMO": "https://wwwn.cdc.gov/Nchs/Nhanes/2015-2016/DEMO_I.xpt",
-        "MCQ": "https://wwwn.cdc.gov/Nchs/Nhanes/2015-2016/MCQ_I.xpt",
-        "BPQ": "https://wwwn.cdc.gov/Nchs/Nhanes/2015-2016/BPQ_I.xpt",
-        "DIQ": "https://wwwn.cdc.gov/Nchs/Nhanes/2015-2016/DIQ_I.xpt",
-        "SMQ": "https://wwwn.cdc.gov/Nchs/Nhanes/2015-2016/SMQ_I.xpt",
-        "PAQ": "https://wwwn.cdc.gov/Nchs/Nhanes/2015-2016/PAQ_I.xpt",
-        "BMX": "https://wwwn.cdc.gov/Nchs/Nhanes/2015-2016/BMX_I.xpt",
-        "BPX": "https://wwwn.cdc.gov/Nchs/Nhanes/2015-2016/BPX_I.xpt",
-        "GHB": "https://wwwn.cdc.gov/Nchs/Nhanes/2015-2016/GHB_I.xpt",
-        "GLU": "https://wwwn.cdc.gov/Nchs/Nhanes/2015-2016/GLU_I.xpt",
-        "TCHOL": "https://wwwn.cdc.gov/Nchs/Nhanes/2015-2016/TCHOL_I.xpt",
-        "HDL": "https://wwwn.cdc.gov/Nchs/Nhanes/2015-2016/HDL_I.xpt",
-        "TRIGLY": "https://wwwn.cdc.gov/Nchs/Nhanes/2015-2016/TRIGLY_I.xpt",
-    },
-    
-    # === Era 3: 2013-2014 ===
-    "2013-2014": {
-        "DEMO": "https://wwwn.cdc.gov/Nchs/Nhanes/2013-2014/DEMO_H.xpt",
-        "MCQ": "https://wwwn.cdc.gov/Nchs/Nhanes/2013-2014/MCQ_H.xpt",
-        "BPQ": "https://wwwn.cdc.gov/Nchs/Nhanes/2013-2014/BPQ_H.xpt",
-        "DIQ": "https://wwwn.cdc.gov/Nchs/Nhanes/2013-2014/DIQ_H.xpt",
-        "SMQ": "https://wwwn.cdc.gov/Nchs/Nhanes/2013-2014/SMQ_H.xpt",
-        "PAQ": "https://wwwn.cdc.gov/Nchs/Nhanes/2013-2014/PAQ_H.xpt",
-        "BMX": "https://wwwn.cdc.gov/Nchs/Nhanes/2013-2014/BMX_H.xpt",
-        "BPX": "https://wwwn.cdc.gov/Nchs/Nhanes/2013-2014/BPX_H.xpt",
-        "GHB": "https://wwwn.cdc.gov/Nchs/Nhanes/2013-2014/GHB_H.xpt",
-        "GLU": "https://wwwn.cdc.gov/Nchs/Nhanes/2013-2014/GLU_H.xpt",
-        "TCHOL": "https://wwwn.cdc.gov/Nchs/Nhanes/2013-2014/TCHOL_H.xpt",
-        "HDL": "https://wwwn.cdc.gov/Nchs/Nhanes/2013-2014/HDL_H.xpt",
-        "TRIGLY": "https://wwwn.cdc.gov/Nchs/Nhanes/2013-2014/TRIGLY_H.xpt",
-    },
-    
-    # === Era 3: 2011-2012 ===
-    "2011-2012": {
-        "DEMO": "https://wwwn.cdc.gov/Nchs/Nhanes/2011-2012/DEMO_G.xpt",
-        "MCQ": "https://wwwn.cdc.gov/Nchs/Nhanes/2011-2012/MCQ_G.xpt",
-        "BPQ": "https://wwwn.cdc.gov/Nchs/Nhanes/2011-2012/BPQ_G.xpt",
-        "DIQ": "https://wwwn.cdc.gov/Nchs/Nhanes/2011-2012/DIQ_G.xpt",
-        "SMQ": "https://wwwn.cdc.gov/Nchs/Nhanes/2011-2012/SMQ_G.xpt",
-        "PAQ": "https://wwwn.cdc.gov/Nchs/Nhanes/2011-2012/PAQ_G.xpt",
-        "BMX": "https://wwwn.cdc.gov/Nchs/Nhanes/2011-2012/BMX_G.xpt",
-        "BPX": "https://wwwn.cdc.gov/Nchs/Nhanes/2011-2012/BPX_G.xpt",
-        "GHB": "https://wwwn.cdc.gov/Nchs/Nhanes/2011-2012/GHB_G.xpt",
-        "GLU": "https://wwwn.cdc.gov/Nchs/Nhanes/2011-2012/GLU_G.xpt",
-        "TCHOL": "https://wwwn.cdc.gov/Nchs/Nhanes/2011-2012/TCHOL_G.xpt",
-        "HDL": "https://wwwn.cdc.gov/Nchs/Nhanes/2011-2012/HDL_G.xpt",
-        "TRIGLY": "https://wwwn.cdc.gov/Nchs/Nhanes/2011-2012/TRIGLY_G.xpt",
-    },
-    
-    # === Era 3: 2009-2010 ===
-    "2009-2010": {
-        "DEMO": "https://wwwn.cdc.gov/Nchs/Nhanes/2009-2010/DEMO_F.xpt",
-        "MCQ": "https://wwwn.cdc.gov/Nchs/Nhanes/2009-2010/MCQ_F.xpt",
-        "BPQ": "https://wwwn.cdc.gov/Nchs/Nhanes/2009-2010/BPQ_F.xpt",
-        "DIQ": "https://wwwn.cdc.gov/Nchs/Nhanes/2009-2010/DIQ_F.xpt",
-        "SMQ": "https://wwwn.cdc.gov/Nchs/Nhanes/2009-2010/SMQ_F.xpt",
-        "PAQ": "https://wwwn.cdc.gov/Nchs/Nhanes/2009-2010/PAQ_F.xpt",
-        "BMX": "https://wwwn.cdc.gov/Nchs/Nhanes/2009-2010/BMX_F.xpt",
-        "BPX": "https://wwwn.cdc.gov/Nchs/Nhanes/2009-2010/BPX_F.xpt",
-        "GHB": "https://wwwn.cdc.gov/Nchs/Nhanes/2009-2010/GHB_F.xpt",
-        "GLU": "https://wwwn.cdc.gov/Nchs/Nhanes/2009-2010/GLU_F.xpt",
-        "TCHOL": "https://wwwn.cdc.gov/Nchs/Nhanes/2009-2010/TCHOL_F.xpt",
-        "HDL": "https://wwwn.cdc.gov/Nchs/Nhanes/2009-2010/HDL_F.xpt",
-        "TRIGLY": "https://wwwn.cdc.gov/Nchs/Nhanes/2009-2010/TRIGLY_F.xpt",
-    },
-    
-    # === Era 3: 2007-2008 ===
-    "2007-2008": {
-        "DEMO": "https://wwwn.cdc.gov/Nchs/Nhanes/2007-2008/DEMO_E.xpt",
-        "MCQ": "https://wwwn.cdc.gov/Nchs/Nhanes/2007-2008/MCQ_E.xpt",
-        "BPQ": "https://wwwn.cdc.gov/Nchs/Nhanes/2007-2008/BPQ_E.xpt",
-        "DIQ": "https://wwwn.cdc.gov/Nchs/Nhanes/2007-2008/DIQ_E.xpt",
-        "SMQ": "https://wwwn.cdc.gov/Nchs/Nhanes/2007-2008/SMQ_E.xpt",
-        "PAQ": "https://wwwn.cdc.gov/Nchs/Nhanes/2007-2008/PAQ_E.xpt",
-        "BMX": "https://wwwn.cdc.gov/Nchs/Nhanes/2007-2008/BMX_E.xpt",
-        "BPX": "https://wwwn.cdc.gov/Nchs/Nhanes/2007-2008/BPX_E.xpt",
-        "GHB": "https://wwwn.cdc.gov/Nchs/Nhanes/2007-2008/GHB_E.xpt",
-        "GLU": "https://wwwn.cdc.gov/Nchs/Nhanes/2007-2008/GLU_E.xpt",
-        "TCHOL": "https://wwwn.cdc.gov/Nchs/Nhanes/2007-2008/TCHOL_E.xpt",
-        "HDL": "https://wwwn.cdc.gov/Nchs/Nhanes/2007-2008/HDL_E.xpt",
-        "TRIGLY": "https://wwwn.cdc.gov/Nchs/Nhanes/2007-2008/TRIGLY_E.xpt",
-    },
-    
-    # === Era 2: 2005-2006 ===
-    "2005-2006": {
-        "DEMO": "https://wwwn.cdc.gov/Nchs/Nhanes/2005-2006/DEMO_D.xpt",
-        "MCQ": "https://wwwn.cdc.gov/Nchs/Nhanes/2005-2006/MCQ_D.xpt",
-        "BPQ": "https://wwwn.cdc.gov/Nchs/Nhanes/2005-2006/BPQ_D.xpt",
-        "DIQ": "https://wwwn.cdc.gov/Nchs/Nhanes/2005-2006/DIQ_D.xpt",
-        "SMQ": "https://wwwn.cdc.gov/Nchs/Nhanes/2005-2006/SMQ_D.xpt",
-        "PAQ": "https://wwwn.cdc.gov/Nchs/Nhanes/2005-2006/PAQ_D.xpt",
-        "BMX": "https://wwwn.cdc.gov/Nchs/Nhanes/2005-2006/BMX_D.xpt",
-        "BPX": "https://wwwn.cdc.gov/Nchs/Nhanes/2005-2006/BPX_D.xpt",
-        "GHB": "https://wwwn.cdc.gov/Nchs/Nhanes/2005-2006/GHB_D.xpt",
-        "GLU": "https://wwwn.cdc.gov/Nchs/Nhanes/2005-2006/GLU_D.xpt",
-        "TCHOL": "https://wwwn.cdc.gov/Nchs/Nhanes/2005-2006/TCHOL_D.xpt",
-        "HDL": "https://wwwn.cdc.gov/Nchs/Nhanes/2005-2006/HDL_D.xpt",
-        "TRIGLY": "https://wwwn.cdc.gov/Nchs/Nhanes/2005-2006/TRIGLY_D.xpt",
-    },
-    
-    # === Era 2: 2003-2004 ===
-    "2003-2004": {
-        "DEMO": "https://wwwn.cdc.gov/Nchs/Nhanes/2003-2004/DEMO_C.xpt",
-        "MCQ": "https://wwwn.cdc.gov/Nchs/Nhanes/2003-2004/MCQ_C.xpt",
-        "BPQ": "https://wwwn.cdc.gov/Nchs/Nhanes/2003-2004/BPQ_C.xpt",
-        "DIQ": "https://wwwn.cdc.gov/Nchs/Nhanes/2003-2004/DIQ_C.xpt",
-        "SMQ": "https://wwwn.cdc.gov/Nchs/Nhanes/2003-2004/SMQ_C.xpt",
-        "PAQ": "https://wwwn.cdc.gov/Nchs/Nhanes/2003-2004/PAQ_C.xpt",
-        "BMX": "https://wwwn.cdc.gov/Nchs/Nhanes/2003-2004/BMX_C.xpt",
-        "BPX": "https://wwwn.cdc.gov/Nchs/Nhanes/2003-2004/BPX_C.xpt",
-        "GHB": "https://wwwn.cdc.gov/Nchs/Nhanes/2003-2004/L10_C.xpt",
-        "GLU": "https://wwwn.cdc.gov/Nchs/Nhanes/2003-2004/L10AM_C.xpt",
-        "TCHOL": "https://wwwn.cdc.gov/Nchs/Nhanes/2003-2004/L13_C.xpt",
-        "HDL": "https://wwwn.cdc.gov/Nchs/Nhanes/2003-2004/L13_C.xpt",  # Same file as TCHOL
-        "TRIGLY": "https://wwwn.cdc.gov/Nchs/Nhanes/2003-2004/L13AM_C.xpt",
-    },
-    
-    # === Era 2: 2001-2002 ===
-    "2001-2002": {
-        "DEMO": "https://wwwn.cdc.gov/Nchs/Nhanes/2001-2002/DEMO_B.xpt",
-        "MCQ": "https://wwwn.cdc.gov/Nchs/Nhanes/2001-2002/MCQ_B.xpt",
-        "BPQ": "https://wwwn.cdc.gov/Nchs/Nhanes/2001-2002/BPQ_B.xpt",
-        "DIQ": "https://wwwn.cdc.gov/Nchs/Nhanes/2001-2002/DIQ_B.xpt",
-        "SMQ": "https://wwwn.cdc.gov/Nchs/Nhanes/2001-2002/SMQ_B.xpt",
-        "PAQ": "https://wwwn.cdc.gov/Nchs/Nhanes/2001-2002/PAQ_B.xpt",
-        "BMX": "https://wwwn.cdc.gov/Nchs/Nhanes/2001-2002/BMX_B.xpt",
-        "BPX": "https://wwwn.cdc.gov/Nchs/Nhanes/2001-2002/BPX_B.xpt",
-        "GHB": "https://wwwn.cdc.gov/Nchs/Nhanes/2001-2002/L10_B.xpt",
-        "GLU": "https://wwwn.cdc.gov/Nchs/Nhanes/2001-2002/L10AM_B.xpt",
-        "TCHOL": "https://wwwn.cdc.gov/Nchs/Nhanes/2001-2002/L13_B.xpt",
-        "HDL": "https://wwwn.cdc.gov/Nchs/Nhanes/2001-2002/L13_B.xpt",
-        "TRIGLY": "https://wwwn.cdc.gov/Nchs/Nhanes/2001-2002/L13AM_B.xpt",
-    },
-    
-    # === Era 2: 1999-2000 ===
-    "1999-2000": {
-        "DEMO": "https://wwwn.cdc.gov/Nchs/Nhanes/1999-2000/DEMO.xpt",
-        "MCQ": "https://wwwn.cdc.gov/Nchs/Nhanes/1999-2000/MCQ.xpt",
-        "BPQ": "https://wwwn.cdc.gov/Nchs/Nhanes/1999-2000/BPQ.xpt",
-        "DIQ": "https://wwwn.cdc.gov/Nchs/Nhanes/1999-2000/DIQ.xpt",
-        "SMQ": "https://wwwn.cdc.gov/Nchs/Nhanes/1999-2000/SMQ.xpt",
-        "PAQ": "https://wwwn.cdc.gov/Nchs/Nhanes/1999-2000/PAQ.xpt",
-        "BMX": "https://wwwn.cdc.gov/Nchs/Nhanes/1999-2000/BMX.xpt",
-        "BPX": "https://wwwn.cdc.gov/Nchs/Nhanes/1999-2000/BPX.xpt",
-        "GHB": "https://wwwn.cdc.gov/Nchs/Nhanes/1999-2000/LAB10.xpt",
-        "GLU": "https://wwwn.cdc.gov/Nchs/Nhanes/1999-2000/LAB10AM.xpt",
-        "TCHOL": "https://wwwn.cdc.gov/Nchs/Nhanes/1999-2000/LAB13.xpt",
-        "HDL": "https://wwwn.cdc.gov/Nchs/Nhanes/1999-2000/LAB13.xpt",
-        "TRIGLY": "https://wwwn.cdc.gov/Nchs/Nhanes/1999-2000/LAB13AM.xpt",
-    },
+# Headers to mimic browser
+HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
+    'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8',
+}
+
+# One unverified SSL context shared by every connection (built once, enables TLS session reuse)
+SSL_CTX = ssl._create_unverified_context()
+
+
+class SSLContextAdapter(HTTPAdapter):
+    """HTTPAdapter whose connection pools all use the shared SSL_CTX."""
+
+    def init_poolmanager(self, *args, **kwargs):
+        kwargs["ssl_context"] = SSL_CTX
+        return super().init_poolmanager(*args, **kwargs)
+
+
+# One pooled session for every download so connections to wwwn.cdc.gov are kept alive
+SESSION = requests.Session()
+SESSION.headers.update(HEADERS)
+SESSION.verify = False
+SESSION.mount("https://", SSLContextAdapter(
+    pool_connections=4,
+    pool_maxsize=16,
+    max_retries=Retry(total=5, backoff_factor=1.0, status_forcelist=[502, 503, 504]),
+))
+
+# Concurrent downloads - the bulk download is network-latency bound
+MAX_WORKERS = 8
+
+# Anything smaller on disk is treated as a failed/partial download
+MIN_VALID_SIZE = 50000
+
+# Read/write size when streaming a response to disk (urllib's default is 8 KB)
+CHUNK_SIZE = 1 << 20
+
+# ETag/Last-Modified of every downloaded file, used to revalidate with conditional GETs
+HTTP_CACHE_PATH = DATA_RAW / ".http_cache.json"
+HTTP_CACHE = {}
+
+# {cycle: {component: filename}} for 02_harmonize_variables.py; components may share a file
+MANIFEST_PATH = DATA_RAW / "manifest.json"
+
+# === NHANES data file URLs (generated per cycle and component) ===
+NHANES_URL = "https://wwwn.cdc.gov/Nchs/Data/Nhanes/Public/{year}/DataFiles/{name}.xpt"
+
+COMPONENTS = ["DEMO", "MCQ", "BPQ", "DIQ", "SMQ", "PAQ", "BMX", "BPX",
+              "GHB", "GLU", "TCHOL", "HDL", "TRIGLY"]
+
+# File name pattern per cycle: suffix letter, or the P_ prefix for the 2017-March 2020 pre-pandemic files
+CYCLE_FILENAME = {
+    "2021-2023": "{}_L",    # Era 4b (post-pandemic)
+    "2017-2020": "P_{}",    # Era 4a
+    "2015-2016": "{}_I",    # Era 4a
+    "2013-2014": "{}_H",    # Era 3
+    "2011-2012": "{}_G",
+    "2009-2010": "{}_F",
+    "2007-2008": "{}_E",
+    "2005-2006": "{}_D",    # Era 2
+    "2003-2004": "{}_C",
+    "2001-2002": "{}_B",
+    "1999-2000": "{}",
+}
+
+# Components whose file base name differs from the component name in a cycle.
+# Before 2005 the labs were bundled (TCHOL and HDL share one file).
+COMPONENT_OVERRIDES = {
+    "2021-2023": {"BPX": "BPXO"},
+    "2017-2020": {"BPX": "BPXO"},
+    "2003-2004": {"GHB": "L10", "GLU": "L10AM", "TCHOL": "L13", "HDL": "L13", "TRIGLY": "L13AM"},
+    "2001-2002": {"GHB": "L10", "GLU": "L10AM", "TCHOL": "L13", "HDL": "L13", "TRIGLY": "L13AM"},
+    "1999-2000": {"GHB": "LAB10", "GLU": "LAB10AM", "TCHOL": "LAB13", "HDL": "LAB13", "TRIGLY": "LAB13AM"},
 }
 
+
+def nhanes_url(cycle: str, component: str) -> str:
+    """Build the CDC download URL for one component of a Continuous NHANES cycle."""
+    base_name = COMPONENT_OVERRIDES.get(cycle, {}).get(component, component)
+    return NHANES_URL.format(year=cycle[:4], name=CYCLE_FILENAME[cycle].format(base_name))
+
+
+def nhanes_files() -> dict:
+    """All Continuous NHANES URLs as {cycle: {component: url}}."""
+    return {cycle: {component: nhanes_url(cycle, component) for component in COMPONENTS}
+            for cycle in CYCLE_FILENAME}
+
 # NHANES III files (different structure)
 NHANES_III_FILES = {
     "adult": "https://wwwn.cdc.gov/nchs/data/nhanes3/1a/adult.xpt",
@@ -219,56 +123,150 @@ MORTALITY_FILES = {
 }
 
 
-def download_file(url: str, dest_path: Path) -> bool:
-    """Download a file from URL to destination path."""
+def load_http_cache() -> dict:
+    """Load the url -> {etag, last_modified, size} cache from a previous run."""
+    if HTTP_CACHE_PATH.exists():
+        with open(HTTP_CACHE_PATH) as f:
+            return json.load(f)
+    return {}
+
+
+def save_http_cache(cache: dict):
+    """Persist the HTTP validator cache next to the raw data."""
+    with open(HTTP_CACHE_PATH, 'w') as f:
+        json.dump(cache, f, indent=1, sort_keys=True)
+
+
+def plan_downloads(targets: dict, refresh: bool = False) -> list:
+    """
+    Build the download work list from {directory: [url, ...]}.
+    Each directory is listed once with os.scandir. Files already larger than
+    MIN_VALID_SIZE are skipped unless refresh is set and their validators are
+    cached, in which case they are scheduled for a conditional GET.
+    Returns [(url, dest_path, validators), ...].
+    """
+    plan = []
+    scheduled = set()
+    for directory, urls in targets.items():
+        directory.mkdir(parents=True, exist_ok=True)
+        with os.scandir(directory) as entries:
+            sizes = {e.name: e.stat().st_size for e in entries if e.is_file()}
+        
+        for url in urls:
+            # Some components share a file (e.g. TCHOL/HDL) - fetch each URL once
+            if url in scheduled:
+                continue
+            scheduled.add(url)
+            
+            filename = url.split("/")[-1]
+            validators = HTTP_CACHE.get(url)
+            if sizes.get(filename, 0) > MIN_VALID_SIZE:
+                if not (refresh and validators):
+                    continue
+            else:
+                validators = None
+            plan.append((url, directory / filename, validators))
+    return plan
+
+
+def download_file(url: str, dest_path: Path, validators: dict = None) -> bool:
+    """
+    Download a file from URL to destination path.
+    With cached validators the request is conditional (If-None-Match/If-Modified-Since)
+    and a 304 leaves the local copy untouched.
+    """
     try:
-        if dest_path.exists():
-            print(f"  [EXISTS] {dest_path.name}")
-            return True
+        headers = {}
+        if validators:
+            if validators.get("etag"):
+                headers["If-None-Match"] = validators["etag"]
+            if validators.get("last_modified"):
+                headers["If-Modified-Since"] = validators["last_modified"]
+            print(f"  [CHECKING] {url.split('/')[-1]}...")
+        else:
+            print(f"  [DOWNLOADING] {url.split('/')[-1]}...")
         
-        print(f"  [DOWNLOADING] {url.split('/')[-1]}...")
-        urllib.request.urlretrieve(url, dest_path)
-        print(f"  [SUCCESS] {dest_path.name}")
+        tmp_path = dest_path.with_name(dest_path.name + ".part")
+        with SESSION.get(url, headers=headers, stream=True, timeout=60) as r:
+            if r.status_code == 304:
+                print(f"  [UNCHANGED] {dest_path.name}")
+                return True
+            r.raise_for_status()
+            
+            # Check we got actual data (not an HTML error page) before reading the body
+            content_type = r.headers.get('Content-Type', '')
+            if content_type.startswith('text/html'):
+                print(f"  [FAILED] {dest_path.name} - got {content_type}")
+                return False
+            
+            r.raw.decode_content = True
+            with open(tmp_path, 'wb') as f:
+                shutil.copyfileobj(r.raw, f, length=CHUNK_SIZE)
+        
+        size = tmp_path.stat().st_size
+        expected = r.headers.get('Content-Length')
+        if expected is not None and 'Content-Encoding' not in r.headers and int(expected) != size:
+            tmp_path.unlink()
+            print(f"  [FAILED] {dest_path.name} - got {size} of {expected} bytes")
+            return False
+        
+        tmp_path.replace(dest_path)
+        HTTP_CACHE[url] = {
+            "etag": r.headers.get("ETag"),
+            "last_modified": r.headers.get("Last-Modified"),
+            "size": size,
+        }
+        print(f"  [SUCCESS] {dest_path.name} ({size} bytes)")
         return True
     except Exception as e:
         print(f"  [ERROR] {url}: {e}")
         return False
 
 
-def download_continuous_nhanes():
+def download_continuous_nhanes(refresh: bool = False):
     """Download all Continuous NHANES files (1999-2023)."""
     print("\n" + "="*60)
     print("DOWNLOADING CONTINUOUS NHANES DATA (1999-2023)")
     print("="*60)
     
-    for cycle, files in NHANES_FILES.items():
-        cycle_dir = DATA_RAW / cycle
-        cycle_dir.mkdir(parents=True, exist_ok=True)
-        
-        print(f"\n[{cycle}]")
-        for component, url in files.items():
-            filename = url.split("/")[-1]
-            dest_path = cycle_dir / filename
-            download_file(url, dest_path)
+    files_by_cycle = nhanes_files()
+    plan = plan_downloads(
+        {DATA_RAW / cycle: list(files.values()) for cycle, files in files_by_cycle.items()},
+        refresh=refresh,
+    )
+    
+    print(f"\n[Downloading {len(plan)} files, {MAX_WORKERS} at a time]")
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        results = list(executor.map(lambda task: download_file(*task), plan))
+    print(f"\n  {sum(results)}/{len(results)} files downloaded")
+    
+    # Record which file backs each component so harmonization opens shared files once
+    manifest = {
+        cycle: {component: url.split("/")[-1] for component, url in files.items()}
+        for cycle, files in files_by_cycle.items()
+    }
+    with open(MANIFEST_PATH, 'w') as f:
+        json.dump(manifest, f, indent=1)
 
 
-def download_nhanes_iii():
+def download_nhanes_iii(refresh: bool = False):
     """Download NHANES III files (1988-1994)."""
     print("\n" + "="*60)
     print("DOWNLOADING NHANES III DATA (1988-1994)")
     print("="*60)
     
-    nh3_dir = DATA_RAW / "NHANES_III"
-    nh3_dir.mkdir(parents=True, exist_ok=True)
-    
-    for name, url in NHANES_III_FILES.items():
-        filename = url.split("/")[-1]
-        dest_path = nh3_dir / filename
-        download_file(url, dest_path)
+    plan = plan_downloads({DATA_RAW / "NHANES_III": list(NHANES_III_FILES.values())}, refresh=refresh)
+    for url, dest_path, validators in plan:
+        download_file(url, dest_path, validators)
 
 
 def main():
     """Main download function."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--refresh", action="store_true",
+                        help="revalidate existing files against the CDC server (conditional GET)")
+    args = parser.parse_args()
+    
     print("\n" + "="*60)
     print("NHANES CHD STUDY - DATA DOWNLOAD")
     print("="*60)
@@ -276,10 +274,14 @@ def main():
     
     # Create directories
     DATA_RAW.mkdir(parents=True, exist_ok=True)
+    HTTP_CACHE.update(load_http_cache())
     
     # Download all data
-    download_continuous_nhanes()
-    download_nhanes_iii()
+    try:
+        download_continuous_nhanes(refresh=args.refresh)
+        download_nhanes_iii(refresh=args.refresh)
+    finally:
+        save_http_cache(HTTP_CACHE)
     
     print("\n" + "="*60)
     print("DOWNLOAD COMPLETE")
@@ -3,14 +3,27 @@ NHANES CHD Study - Variable Harmonization
 Creates unified variable definitions across all NHANES cycles (1988-2023)
 """
 
+import os
+import json
+import functools
+import warnings
 import pandas as pd
 import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pyreadstat
 from pathlib import Path
 
 PROJECT_ROOT = Path(__file__).parent.parent
 DATA_RAW = PROJECT_ROOT / "data" / "raw"
 DATA_PROCESSED = PROJECT_ROOT / "data" / "processed"
 
+# {cycle: {component: filename}} written by 01_download_data.py
+MANIFEST_PATH = DATA_RAW / "manifest.json"
+
+# Column-pruned Parquet copies of each cycle's XPT components
+XPT_CACHE = DATA_PROCESSED / "xpt_cache"
+
 # ============================================================================
 # VARIABLE HARMONIZATION CROSSWALK
 # ============================================================================
@@ -156,38 +169,142 @@ PA_VARS = {
 }
 
 
-def load_xpt(filepath: Path) -> pd.DataFrame:
-    """Load XPT file into pandas DataFrame."""
+# Raw Continuous NHANES variables referenced above - XPT reads are limited to these
+XPT_COLUMNS = sorted({"SEQN"}.union(
+    *(mapping["continuous"].values() for mapping in (CHD_VARS, DEMO_VARS, RISK_FACTOR_VARS)),
+    *(mapping.values() for mapping in PA_VARS.values()),
+))
+
+
+# Outcome and risk-factor variables are small codes or 1-decimal measurements - float32 is exact enough.
+# Demographics (age, survey weights, design variables) keep full precision.
+DOWNCAST_FLOAT = set(CHD_VARS["continuous"].values()) | set(RISK_FACTOR_VARS["continuous"].values())
+
+# Repeated BP readings averaged for hypertension
+SBP_COLS = tuple(k for k in RISK_FACTOR_VARS["continuous"] if k.startswith("sbp"))
+DBP_COLS = tuple(k for k in RISK_FACTOR_VARS["continuous"] if k.startswith("dbp"))
+
+# Inputs to compute_derived_risk_factors, in unpacking order
+RISK_INPUT_COLS = ["hba1c", "glucose", "insulin_use", "oral_dm_med", "diabetes_told",
+                   "tchol", "ldl_calc", "bmi"]
+
+# 0/1 flags and small integer codes written as nullable Int8 (NaN becomes <NA>)
+INT8_COLS = ["RIAGENDR", "RIDRETH1", "chd_composite", "hypertension", "diabetes",
+             "hyperlipidemia", "obesity", "smoking_status"]
+
+# Repeated labels stored as categoricals; one fixed category list so every cycle concatenates as codes
+CATEGORICAL_COLS = {
+    "cycle": list(ERA_MAPPING),
+    "era": sorted(set(ERA_MAPPING.values())),
+}
+
+
+def load_manifest() -> dict:
+    """Load the component -> file map for each cycle, if the downloader wrote one."""
+    if MANIFEST_PATH.exists():
+        with open(MANIFEST_PATH) as f:
+            return json.load(f)
+    return {}
+
+
+def list_xpt_files(cycle_dir: Path) -> dict:
+    """All XPT files in a cycle directory (either extension case) as {name: path}, from one scandir."""
+    with os.scandir(cycle_dir) as entries:
+        return {e.name: Path(e.path) for e in sorted(entries, key=lambda e: e.name)
+                if e.is_file() and e.name.lower().endswith('.xpt')}
+
+
+def find_component_file(xpt_files: dict, component: str, files: dict):
+    """
+    Locate the XPT file for a component: the manifest entry when present,
+    otherwise the first filename match.
+    """
+    if files.get(component) in xpt_files:
+        return xpt_files[files[component]]
+    
+    if component == "DEMO":
+        matches = [name for prefix in ("DEMO", "P_DEMO") for name in xpt_files if name.startswith(prefix)]
+    else:
+        matches = [name for name in xpt_files if component in name[:-len('.xpt')]]
+    return xpt_files[matches[0]] if matches else None
+
+
+def load_xpt(filepath: Path, usecols: list = None) -> pd.DataFrame:
+    """Load XPT file into pandas DataFrame (ReadStat C reader; usecols not in the file are ignored)."""
     try:
-        return pd.read_sas(filepath, format='xport', encoding='latin1')
+        df, _ = pyreadstat.read_xport(str(filepath), encoding='latin1', usecols=usecols)
+        return df
     except Exception as e:
         print(f"Error loading {filepath}: {e}")
         return pd.DataFrame()
 
 
+def load_or_build(cycle: str, component: str, xpt_path: Path, needed_cols: list) -> pd.DataFrame:
+    """
+    Load a component from its Parquet cache, or parse the XPT and cache it.
+    The cache is stale if the XPT (e.g. re-downloaded after an ETag change)
+    or this script (e.g. a crosswalk edit) is newer than it.
+    """
+    cache_path = XPT_CACHE / f"{cycle}_{component}.parquet"
+    source_mtime = max(xpt_path.stat().st_mtime, Path(__file__).stat().st_mtime)
+    if cache_path.exists() and cache_path.stat().st_mtime > source_mtime:
+        try:
+            return pd.read_parquet(cache_path)
+        except (OSError, ValueError):
+            pass  # Unreadable cache (e.g. copied in part) - rebuild it
+    
+    df = load_xpt(xpt_path, usecols=needed_cols)
+    if len(df) > 0:
+        # Written beside the cache and renamed into place, so an interrupted run
+        # never leaves a truncated cache that looks newer than its XPT
+        XPT_CACHE.mkdir(parents=True, exist_ok=True)
+        tmp_path = cache_path.with_name(cache_path.name + ".part")
+        try:
+            df.to_parquet(tmp_path, compression='snappy', index=False)
+            tmp_path.replace(cache_path)
+        finally:
+            tmp_path.unlink(missing_ok=True)
+    return df
+
+
+def downcast_cycle(df: pd.DataFrame) -> pd.DataFrame:
+    """Shrink a cycle's frame before concat: float32 measurements, shared categoricals for labels."""
+    for col in DOWNCAST_FLOAT.intersection(df.columns):
+        df[col] = pd.to_numeric(df[col], downcast='float')
+    for col, categories in CATEGORICAL_COLS.items():
+        if col in df.columns:
+            df[col] = pd.Categorical(df[col], categories=categories)
+    return df
+
+
+@functools.lru_cache(maxsize=4)
+def _nan(n: int) -> np.ndarray:
+    """Shared read-only all-NaN float32 column of length n, standing in for a missing variable."""
+    arr = np.full(n, np.nan, dtype='float32')
+    arr.flags.writeable = False
+    return arr
+
+
+def _col(df: pd.DataFrame, name: str) -> np.ndarray:
+    """Column as a float32 array, or the shared NaN column if the variable is absent."""
+    return df[name].to_numpy(dtype='float32') if name in df.columns else _nan(len(df))
+
+
 def create_chd_composite(df: pd.DataFrame, var_type: str = "continuous") -> pd.Series:
     """
     Create composite CHD outcome: positive if ANY of CHD, angina, or MI = Yes (1).
     """
     vars = CHD_VARS[var_type]
     
-    # Get individual conditions (1 = Yes, 2 = No in NHANES coding)
-    chd = df.get(vars["chd"], pd.Series([np.nan] * len(df)))
-    angina = df.get(vars["angina"], pd.Series([np.nan] * len(df)))
-    mi = df.get(vars["mi"], pd.Series([np.nan] * len(df)))
+    # Individual conditions stacked into one (n, 3) block (1 = Yes, 2 = No in NHANES coding)
+    conditions = np.column_stack([_col(df, vars[c]) for c in ("chd", "angina", "mi")])
     
     # Composite: 1 if any is 1 (Yes), 0 if all are 2 (No), NaN otherwise
-    composite = pd.Series([np.nan] * len(df))
+    any_yes = (conditions == 1).any(axis=1)
+    all_no = (conditions == 2).all(axis=1)
+    composite = np.where(any_yes, np.float32(1), np.where(all_no, np.float32(0), np.float32(np.nan)))
     
-    # Any positive = CHD positive
-    any_yes = (chd == 1) | (angina == 1) | (mi == 1)
-    composite[any_yes] = 1
-    
-    # All negative = CHD negative
-    all_no = (chd == 2) & (angina == 2) & (mi == 2)
-    composite[all_no] = 0
-    
-    return composite
+    return pd.Series(composite, index=df.index)
 
 
 def calculate_ldl(df: pd.DataFrame) -> pd.Series:
@@ -195,16 +312,14 @@ def calculate_ldl(df: pd.DataFrame) -> pd.Series:
     Calculate LDL using Friedewald equation: LDL = TC - HDL - (TG/5)
     Only valid when TG < 400 mg/dL.
     """
-    tc = df.get('tchol', pd.Series([np.nan] * len(df)))
-    hdl = df.get('hdl', pd.Series([np.nan] * len(df)))
-    tg = df.get('trigly', pd.Series([np.nan] * len(df)))
-    
-    ldl = tc - hdl - (tg / 5)
+    tc = _col(df, 'tchol')
+    hdl = _col(df, 'hdl')
+    tg = _col(df, 'trigly')
     
-    # Set to NaN if TG >= 400 (Friedewald not valid)
-    ldl[tg >= 400] = np.nan
+    # NaN if TG >= 400 (Friedewald not valid); missing TG already gives NaN
+    ldl = np.where(tg >= 400, np.float32(np.nan), tc - hdl - tg * np.float32(0.2))
     
-    return ldl
+    return pd.Series(ldl, index=df.index)
 
 
 def define_hypertension(df: pd.DataFrame) -> pd.Series:
@@ -212,107 +327,102 @@ def define_hypertension(df: pd.DataFrame) -> pd.Series:
     Define hypertension per 2017 ACC/AHA guidelines:
     SBP >= 130 OR DBP >= 80 OR taking BP medication.
     """
-    # Calculate mean SBP and DBP from available readings
-    sbp_cols = [c for c in df.columns if c.startswith('sbp')]
-    dbp_cols = [c for c in df.columns if c.startswith('dbp')]
+    # Calculate mean SBP and DBP from available readings (NaN when a participant has none)
+    def mean_reading(cols):
+        cols = [c for c in cols if c in df.columns]
+        if not cols:
+            return _nan(len(df))
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', RuntimeWarning)  # all-NaN rows
+            return np.nanmean(df[cols].to_numpy(dtype='float32'), axis=1)
     
-    mean_sbp = df[sbp_cols].mean(axis=1) if sbp_cols else pd.Series([np.nan] * len(df))
-    mean_dbp = df[dbp_cols].mean(axis=1) if dbp_cols else pd.Series([np.nan] * len(df))
+    mean_sbp = mean_reading(SBP_COLS)
+    mean_dbp = mean_reading(DBP_COLS)
     
-    bp_med = df.get('bp_med', pd.Series([np.nan] * len(df)))
+    bp_med = _col(df, 'bp_med')
     
     # Hypertension: SBP >= 130 OR DBP >= 80 OR BP medication (1 = Yes in NHANES)
-    htn = ((mean_sbp >= 130) | (mean_dbp >= 80) | (bp_med == 1)).astype(float)
-    
-    return htn
-
-
-def define_diabetes(df: pd.DataFrame) -> pd.Series:
-    """
-    Define diabetes: HbA1c >= 6.5% OR FPG >= 126 OR using insulin/oral meds.
-    """
-    hba1c = df.get('hba1c', pd.Series([np.nan] * len(df)))
-    glucose = df.get('glucose', pd.Series([np.nan] * len(df)))
-    insulin = df.get('insulin_use', pd.Series([np.nan] * len(df)))
-    oral_med = df.get('oral_dm_med', pd.Series([np.nan] * len(df)))
-    diabetes_told = df.get('diabetes_told', pd.Series([np.nan] * len(df)))
-    
-    dm = ((hba1c >= 6.5) | 
-          (glucose >= 126) | 
-          (insulin == 1) | 
-          (oral_med == 1) |
-          (diabetes_told == 1)).astype(float)
+    htn = ((mean_sbp >= 130) | (mean_dbp >= 80) | (bp_med == 1)).astype(np.float32)
     
-    return dm
+    return pd.Series(htn, index=df.index)
 
 
-def define_hyperlipidemia(df: pd.DataFrame) -> pd.Series:
+def compute_derived_risk_factors(df: pd.DataFrame) -> dict:
     """
-    Define hyperlipidemia: TC >= 200 OR LDL >= 130.
+    Define diabetes, hyperlipidemia and obesity from one extraction of their inputs:
+      diabetes:       HbA1c >= 6.5% OR FPG >= 126 OR using insulin/oral meds OR told by doctor
+      hyperlipidemia: TC >= 200 OR LDL >= 130
+      obesity:        BMI >= 30
     """
-    tchol = df.get('tchol', pd.Series([np.nan] * len(df)))
-    ldl = df.get('ldl_calc', pd.Series([np.nan] * len(df)))
-    
-    hyperlip = ((tchol >= 200) | (ldl >= 130)).astype(float)
-    
-    return hyperlip
-
-
-def define_obesity(df: pd.DataFrame) -> pd.Series:
-    """Define obesity: BMI >= 30."""
-    bmi = df.get('bmi', pd.Series([np.nan] * len(df)))
-    return (bmi >= 30).astype(float)
+    # Missing inputs come back as NaN columns, which never meet a threshold
+    arr = df.reindex(columns=RISK_INPUT_COLS).to_numpy(dtype='float32')
+    hba1c, glucose, insulin, oral_med, diabetes_told, tchol, ldl, bmi = arr.T
+    
+    return {
+        "diabetes": ((hba1c >= 6.5) | (glucose >= 126) | (insulin == 1) |
+                     (oral_med == 1) | (diabetes_told == 1)).astype(np.float32),
+        "hyperlipidemia": ((tchol >= 200) | (ldl >= 130)).astype(np.float32),
+        "obesity": (bmi >= 30).astype(np.float32),
+    }
 
 
 def define_smoking_status(df: pd.DataFrame) -> pd.Series:
     """
     Define smoking status: 1=Current, 2=Former, 3=Never.
     """
-    smoke_100 = df.get('smoke_100', pd.Series([np.nan] * len(df)))
-    smoke_now = df.get('smoke_now', pd.Series([np.nan] * len(df)))
-    
-    status = pd.Series([np.nan] * len(df))
-    
-    # Never: didn't smoke 100+ cigarettes
-    status[smoke_100 == 2] = 3  # Never
+    smoke_100 = _col(df, 'smoke_100')
+    smoke_now = _col(df, 'smoke_now')
     
     # Current: smoked 100+ and currently smokes (1=every day, 2=some days)
-    status[(smoke_100 == 1) & (smoke_now.isin([1, 2]))] = 1  # Current
+    current = (smoke_100 == 1) & np.isin(smoke_now, [1, 2])
     
     # Former: smoked 100+ but not at all now (3=not at all)
-    status[(smoke_100 == 1) & (smoke_now == 3)] = 2  # Former
+    former = (smoke_100 == 1) & (smoke_now == 3)
+    
+    # Never: didn't smoke 100+ cigarettes
+    never = smoke_100 == 2
     
-    return status
+    status = np.select([current, former, never], [1.0, 2.0, 3.0], default=np.nan)
+    return pd.Series(status, index=df.index)
 
 
 def process_cycle(cycle: str, files: dict) -> pd.DataFrame:
     """Process a single NHANES cycle and return harmonized data."""
     print(f"\n[Processing {cycle}]")
     
-    cycle_dir = DATA_RAW / cycle
+    xpt_files = list_xpt_files(DATA_RAW / cycle)
     
-    # Initialize with demographics - handle both cases
-    demo_file = list(cycle_dir.glob("DEMO*.xpt")) + list(cycle_dir.glob("DEMO*.XPT")) + list(cycle_dir.glob("P_DEMO*.xpt")) + list(cycle_dir.glob("P_DEMO*.XPT"))
-    if not demo_file:
+    # Initialize with demographics
+    demo_file = find_component_file(xpt_files, "DEMO", files)
+    if demo_file is None:
         print(f"  No DEMO file found for {cycle}")
         return pd.DataFrame()
     
-    df = load_xpt(demo_file[0])
+    df = load_or_build(cycle, "DEMO", demo_file, XPT_COLUMNS)
     print(f"  Loaded {len(df)} participants")
     
-    # Merge other files - handle both cases
+    # Join other files - each file once, since TCHOL/HDL share a lab file before 2005.
+    # Components are already projected to XPT_COLUMNS, so SEQN is the only shared column.
+    # Aligning every component to the DEMO index and concatenating once is a left join
+    # without a hash build and full-frame copy per component.
+    df = df.set_index('SEQN')
+    merged = {demo_file}
+    components = []
     for component in ['MCQ', 'BPQ', 'DIQ', 'SMQ', 'PAQ', 'BMX', 'BPX', 'GHB', 'GLU', 'TCHOL', 'HDL', 'TRIGLY']:
-        files = list(cycle_dir.glob(f"*{component}*.xpt")) + list(cycle_dir.glob(f"*{component}*.XPT"))
-        if files:
-            comp_df = load_xpt(files[0])
-            if 'SEQN' in comp_df.columns and len(comp_df) > 0:
-                df = df.merge(comp_df, on='SEQN', how='left', suffixes=('', f'_{component}'))
+        path = find_component_file(xpt_files, component, files)
+        if path is None or path in merged:
+            continue
+        merged.add(path)
+        comp_df = load_or_build(cycle, component, path, XPT_COLUMNS)
+        if 'SEQN' in comp_df.columns and len(comp_df) > 0:
+            components.append(comp_df.set_index('SEQN').reindex(df.index))
+    df = pd.concat([df] + components, axis=1).reset_index()
     
     # Add cycle and era info
     df['cycle'] = cycle
     df['era'] = ERA_MAPPING.get(cycle, 'Unknown')
     
-    return df
+    return downcast_cycle(df)
 
 
 def main():
@@ -322,40 +432,55 @@ def main():
     print("="*60)
     
     all_data = []
+    manifest = load_manifest()
     
     # Process all Continuous NHANES cycles
     cycles = ["1999-2000", "2001-2002", "2003-2004", "2005-2006",
               "2007-2008", "2009-2010", "2011-2012", "2013-2014",
               "2015-2016", "2017-2020", "2021-2023"]
     
+    # Cycle directories present, from one listing of the raw data directory
+    downloaded = set()
+    if DATA_RAW.is_dir():
+        with os.scandir(DATA_RAW) as entries:
+            downloaded = {e.name for e in entries if e.is_dir()}
+    
     for cycle in cycles:
-        cycle_dir = DATA_RAW / cycle
-        if cycle_dir.exists():
-            df = process_cycle(cycle, {})
+        if cycle in downloaded:
+            df = process_cycle(cycle, manifest.get(cycle, {}))
             if len(df) > 0:
-                all_data.append(df)
+                all_data.append(pa.Table.from_pandas(df, preserve_index=False))
     
     # Combine all cycles
     if all_data:
-        combined = pd.concat(all_data, ignore_index=True)
+        # Arrow concatenation only links the cycles' column chunks; columns missing from a
+        # cycle are null-filled, and a column downcast differently across cycles (float32 in
+        # one, float64 in another) is widened as pd.concat would. One conversion back follows.
+        combined = pa.concat_tables(all_data, promote_options="permissive").to_pandas(
+            self_destruct=True, split_blocks=True)
+        del all_data
         
         # Create derived variables
         print("\n[Creating derived variables]")
         combined['chd_composite'] = create_chd_composite(combined)
         combined['ldl_calc'] = calculate_ldl(combined)
         combined['hypertension'] = define_hypertension(combined)
-        combined['diabetes'] = define_diabetes(combined)
-        combined['hyperlipidemia'] = define_hyperlipidemia(combined)
-        combined['obesity'] = define_obesity(combined)
+        combined = combined.assign(**compute_derived_risk_factors(combined))
         combined['smoking_status'] = define_smoking_status(combined)
         
+        # Narrow flags and codes before writing
+        for col in INT8_COLS:
+            if col in combined.columns:
+                combined[col] = combined[col].astype('Int8')
+        
         # Save processed data
         DATA_PROCESSED.mkdir(parents=True, exist_ok=True)
         output_path = DATA_PROCESSED / "nhanes_chd_harmonized.parquet"
-        combined.to_parquet(output_path)
+        pq.write_table(pa.Table.from_pandas(combined, preserve_index=False), output_path,
+                       compression='zstd', compression_level=3)
         print(f"\n[Saved] {output_path}")
         print(f"Total participants: {len(combined):,}")
-        print(f"Eras: {combined['era'].value_counts().to_dict()}")
+        print(f"Eras: {combined['era'].value_counts().loc[lambda counts: counts > 0].to_dict()}")
     
     print("\n" + "="*60)
     print("HARMONIZATION COMPLETE")
@@ -3,8 +3,11 @@ NHANES CHD Study - Statistical Analysis
 Survey-weighted prevalence estimates and trend analysis
 """
 
+import io
+import sys
 import pandas as pd
 import numpy as np
+import pyarrow.dataset as ds
 from pathlib import Path
 
 PROJECT_ROOT = Path(__file__).parent.parent
@@ -22,12 +25,24 @@ US_STD_2000 = {
     "80+": 0.0229,
 }
 
+# Age group boundaries [lower, upper) in US_STD_2000 order, and the matching weights
+AGE_BINS = np.array([20, 30, 40, 50, 60, 70, 80, 120])
+US_STD_2000_WEIGHTS = np.array(list(US_STD_2000.values()))
+N_AGE_GROUPS = len(US_STD_2000)
 
-def create_age_groups(age: pd.Series) -> pd.Series:
-    """Create age groups for standardization."""
-    bins = [20, 30, 40, 50, 60, 70, 80, 120]
-    labels = ["20-29", "30-39", "40-49", "50-59", "60-69", "70-79", "80+"]
-    return pd.cut(age, bins=bins, labels=labels, right=False)
+# Columns the analyses below read - the scan skips everything else in the harmonized file
+ANALYSIS_COLUMNS = ["era", "RIDAGEYR", "RIAGENDR", "RIDRETH1", "WTMEC2YR", "chd_composite",
+                    "hypertension", "diabetes", "hyperlipidemia", "obesity"]
+
+
+def create_age_groups(age: np.ndarray) -> np.ndarray:
+    """
+    Age group codes for standardization: 0 (20-29) to 6 (80+), indexing US_STD_2000.
+    Ages outside 20-119 or missing get -1.
+    """
+    codes = np.digitize(age, AGE_BINS) - 1
+    codes[codes >= N_AGE_GROUPS] = -1
+    return codes.astype(np.int8)
 
 
 def calculate_survey_weighted_prevalence(df: pd.DataFrame, 
@@ -72,19 +87,46 @@ def calculate_survey_weighted_prevalence(df: pd.DataFrame,
     }
 
 
-def age_standardize(prevalence_by_age: dict) -> float:
+def calculate_survey_weighted_prevalences(df: pd.DataFrame,
+                                           outcomes: list,
+                                           weight: str = "WTMEC2YR") -> pd.DataFrame:
     """
-    Age-standardize prevalence using 2000 US standard population.
+    Survey-weighted prevalence for several outcomes in one pass over the weights.
+    Same estimates as calculate_survey_weighted_prevalence, one row per outcome.
+    """
+    w = df[weight].to_numpy(dtype=float)
+    vals = df[outcomes].to_numpy(dtype=float, na_value=np.nan)
+    
+    # Per-outcome valid cases: outcome and weight both present
+    mask = ~np.isnan(vals) & ~np.isnan(w)[:, None]
+    x = np.where(mask, vals, 0)
+    wm = np.where(mask, w[:, None], 0)
+    n = mask.sum(axis=0)
     
-    prevalence_by_age: dict mapping age group to prevalence
+    with np.errstate(invalid='ignore', divide='ignore'):
+        prevalence = (x * wm).sum(axis=0) / wm.sum(axis=0)
+        se_approx = np.sqrt(prevalence * (1 - prevalence) / n)
+    
+    return pd.DataFrame({
+        "prevalence": prevalence,
+        "se": se_approx,
+        "ci_low": np.maximum(0, prevalence - 1.96 * se_approx),
+        "ci_high": np.minimum(1, prevalence + 1.96 * se_approx),
+        "n": n,
+        "n_cases": x.sum(axis=0).astype(int),
+    }, index=outcomes)
+
+
+def age_standardize(prevalence_by_age: np.ndarray, present: np.ndarray) -> float:
     """
-    standardized = 0
-    total_weight = 0
+    Age-standardize prevalence using 2000 US standard population.
     
-    for age_group, weight in US_STD_2000.items():
-        if age_group in prevalence_by_age:
-            standardized += prevalence_by_age[age_group] * weight
-            total_weight += weight
+    prevalence_by_age: prevalence per age group code (US_STD_2000 order)
+    present: which age groups contribute
+    """
+    weights = US_STD_2000_WEIGHTS[present]
+    standardized = (prevalence_by_age[present] * weights).sum()
+    total_weight = weights.sum()
     
     # Normalize if not all age groups present
     if total_weight > 0 and total_weight < 1:
@@ -95,34 +137,46 @@ def age_standardize(prevalence_by_age: dict) -> float:
 
 def analyze_prevalence_by_era(df: pd.DataFrame) -> pd.DataFrame:
     """Calculate age-standardized CHD prevalence by era."""
-    results = []
+    weight = df['WTMEC2YR'].to_numpy(dtype=float)
+    chd = df['chd_composite'].to_numpy(dtype=float, na_value=np.nan)
+    valid = ~np.isnan(chd) & ~np.isnan(weight)
+    cases = np.where(valid, chd, 0)
+    wx = np.where(valid, chd * weight, 0)
+    w = np.where(valid, weight, 0)
+    
+    # Integer era and age group codes; every sum below is one weighted bincount
+    eras, era_codes = np.unique(df['era'].to_numpy(dtype=str), return_inverse=True)
+    age_codes = create_age_groups(df['RIDAGEYR'].to_numpy(dtype=float, na_value=np.nan))
+    in_age = age_codes >= 0
+    cells = era_codes[in_age] * N_AGE_GROUPS + age_codes[in_age]
+    
+    def by_era(values=None):
+        return np.bincount(era_codes, weights=values, minlength=len(eras))
+    
+    def by_era_age(values=None):
+        return np.bincount(cells, weights=None if values is None else values[in_age],
+                           minlength=len(eras) * N_AGE_GROUPS).reshape(len(eras), N_AGE_GROUPS)
+    
+    n_total, n_valid, n_cases = by_era(), by_era(valid.astype(float)), by_era(cases)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        crude = by_era(wx) / by_era(w)
+        se_approx = np.sqrt(crude * (1 - crude) / n_valid)
+        age_prev = by_era_age(wx) / by_era_age(w)
+    
+    # Age-specific prevalence enters standardization at a minimum sample size of 30
+    age_present = by_era_age() > 30
     
-    for era in sorted(df['era'].unique()):
-        era_df = df[df['era'] == era]
-        
-        # Overall prevalence for era
-        prev = calculate_survey_weighted_prevalence(era_df, 'chd_composite')
-        
-        # Age-specific prevalence for standardization
-        era_df['age_group'] = create_age_groups(era_df['RIDAGEYR'])
-        age_prev = {}
-        for ag in US_STD_2000.keys():
-            ag_df = era_df[era_df['age_group'] == ag]
-            if len(ag_df) > 30:  # Minimum sample size
-                ag_prev = calculate_survey_weighted_prevalence(ag_df, 'chd_composite')
-                age_prev[ag] = ag_prev['prevalence']
-        
-        # Age-standardized prevalence
-        age_std_prev = age_standardize(age_prev) if age_prev else np.nan
-        
+    results = []
+    for i, era in enumerate(eras):
         results.append({
-            "era": era,
-            "n_total": len(era_df),
-            "n_chd": prev['n_cases'],
-            "crude_prevalence": prev['prevalence'],
-            "crude_ci_low": prev['ci_low'],
-            "crude_ci_high": prev['ci_high'],
-            "age_std_prevalence": age_std_prev,
+            "era": str(era),
+            "n_total": int(n_total[i]),
+            "n_chd": int(n_cases[i]),
+            "crude_prevalence": crude[i],
+            "crude_ci_low": max(0, crude[i] - 1.96 * se_approx[i]),
+            "crude_ci_high": min(1, crude[i] + 1.96 * se_approx[i]),
+            "age_std_prevalence": (age_standardize(age_prev[i], age_present[i])
+                                   if age_present[i].any() else np.nan),
         })
     
     return pd.DataFrame(results)
@@ -133,17 +187,17 @@ def analyze_risk_factors_by_era(df: pd.DataFrame) -> pd.DataFrame:
     results = []
     
     risk_factors = ['hypertension', 'diabetes', 'hyperlipidemia', 'obesity']
+    present = [rf for rf in risk_factors if rf in df.columns]
     
     for era in sorted(df['era'].unique()):
         era_df = df[(df['era'] == era) & (df['chd_composite'] == 1)]
         
         row = {"era": era, "n_chd": len(era_df)}
         
-        for rf in risk_factors:
-            if rf in era_df.columns:
-                prev = calculate_survey_weighted_prevalence(era_df, rf)
-                row[f"{rf}_prev"] = prev['prevalence']
-                row[f"{rf}_n"] = prev['n_cases']
+        prevs = calculate_survey_weighted_prevalences(era_df, present)
+        for rf, prev in prevs.iterrows():
+            row[f"{rf}_prev"] = prev['prevalence']
+            row[f"{rf}_n"] = int(prev['n_cases'])
         
         results.append(row)
     
@@ -192,23 +246,27 @@ def main():
         print("Run 02_harmonize_variables.py first.")
         return
     
-    df = pd.read_parquet(data_path)
-    print(f"Loaded {len(df):,} participants")
+    # Exclusions are pushed into the scan; the counts only read the filter columns
+    dataset = ds.dataset(data_path, format="parquet")
+    original_n = dataset.count_rows()
+    print(f"Loaded {original_n:,} participants")
     
     # Apply exclusion criteria
     print("\n[Applying exclusions]")
-    original_n = len(df)
     
     # Age >= 20
-    df = df[df['RIDAGEYR'] >= 20]
-    print(f"  Age >= 20: {len(df):,} ({original_n - len(df):,} excluded)")
+    exclusions = ds.field('RIDAGEYR') >= 20
+    n = dataset.count_rows(filter=exclusions)
+    print(f"  Age >= 20: {n:,} ({original_n - n:,} excluded)")
     
     # Non-missing CHD status
-    df = df[df['chd_composite'].notna()]
-    print(f"  Valid CHD status: {len(df):,}")
+    exclusions &= ds.field('chd_composite').is_valid()
+    print(f"  Valid CHD status: {dataset.count_rows(filter=exclusions):,}")
     
     # Valid survey weights
-    df = df[df['WTMEC2YR'] > 0]
+    exclusions &= ds.field('WTMEC2YR') > 0
+    columns = [c for c in ANALYSIS_COLUMNS if c in dataset.schema.names]
+    df = dataset.to_table(columns=columns, filter=exclusions).to_pandas()
     print(f"  Valid weights: {len(df):,}")
     
     # Create output directory
@@ -216,35 +274,41 @@ def main():
     (OUTPUT / "tables").mkdir(exist_ok=True)
     (OUTPUT / "figures").mkdir(exist_ok=True)
     
+    # Tables and summary are collected in one buffer and written to stdout once
+    report = io.StringIO()
+    
     # =========================================================================
     # Table 1: CHD Prevalence by Era
     # =========================================================================
-    print("\n[Analysis 1: CHD Prevalence by Era]")
+    print("\n[Analysis 1: CHD Prevalence by Era]", file=report)
     table1 = analyze_prevalence_by_era(df)
     table1.to_csv(OUTPUT / "tables" / "table1_chd_prevalence_by_era.csv", index=False)
-    print(table1.to_string(index=False))
+    table1.to_string(buf=report, index=False)
+    report.write("\n")
     
     # =========================================================================
     # Table 2: Risk Factor Prevalence Among CHD Cases
     # =========================================================================
-    print("\n[Analysis 2: Risk Factors Among CHD Cases]")
+    print("\n[Analysis 2: Risk Factors Among CHD Cases]", file=report)
     table2 = analyze_risk_factors_by_era(df)
     table2.to_csv(OUTPUT / "tables" / "table2_risk_factors_by_era.csv", index=False)
-    print(table2.to_string(index=False))
+    table2.to_string(buf=report, index=False)
+    report.write("\n")
     
     # =========================================================================
     # Table 3: CHD Prevalence by Sex
     # =========================================================================
-    print("\n[Analysis 3: CHD Prevalence by Sex]")
+    print("\n[Analysis 3: CHD Prevalence by Sex]", file=report)
     sex_labels = {1: "Male", 2: "Female"}
     table3 = analyze_by_subgroup(df, 'RIAGENDR', sex_labels)
     table3.to_csv(OUTPUT / "tables" / "table3_chd_by_sex.csv", index=False)
-    print(table3.to_string(index=False))
+    table3.to_string(buf=report, index=False)
+    report.write("\n")
     
     # =========================================================================
     # Table 4: CHD Prevalence by Race/Ethnicity
     # =========================================================================
-    print("\n[Analysis 4: CHD Prevalence by Race/Ethnicity]")
+    print("\n[Analysis 4: CHD Prevalence by Race/Ethnicity]", file=report)
     race_labels = {
         1: "Mexican American",
         2: "Other Hispanic", 
@@ -254,28 +318,32 @@ def main():
     }
     table4 = analyze_by_subgroup(df, 'RIDRETH1', race_labels)
     table4.to_csv(OUTPUT / "tables" / "table4_chd_by_race.csv", index=False)
-    print(table4.to_string(index=False))
+    table4.to_string(buf=report, index=False)
+    report.write("\n")
     
     # =========================================================================
     # Summary Statistics
     # =========================================================================
-    print("\n" + "="*60)
-    print("SUMMARY")
-    print("="*60)
-    print(f"Total analytic sample: {len(df):,}")
-    print(f"CHD cases: {int(df['chd_composite'].sum()):,} ({100*df['chd_composite'].mean():.1f}%)")
-    print(f"\nPrevalence by Era:")
-    for _, row in table1.iterrows():
-        print(f"  {row['era']}: {100*row['crude_prevalence']:.2f}% "
-              f"(n={row['n_chd']:,}/{row['n_total']:,})")
-    
-    print(f"\nResults saved to: {OUTPUT / 'tables'}")
-    
-    print("\n" + "="*60)
-    print("ANALYSIS COMPLETE")
-    print("="*60)
-    print("\nNOTE: For publication, re-run analyses in R using the `survey` package")
-    print("or SAS PROC SURVEY procedures for proper variance estimation.")
+    print("\n" + "="*60, file=report)
+    print("SUMMARY", file=report)
+    print("="*60, file=report)
+    print(f"Total analytic sample: {len(df):,}", file=report)
+    print(f"CHD cases: {int(df['chd_composite'].sum()):,} ({100*df['chd_composite'].mean():.1f}%)", file=report)
+    print(f"\nPrevalence by Era:", file=report)
+    report.write("".join(
+        f"  {row.era}: {100*row.crude_prevalence:.2f}% (n={row.n_chd:,}/{row.n_total:,})\n"
+        for row in table1.itertuples(index=False)
+    ))
+    
+    print(f"\nResults saved to: {OUTPUT / 'tables'}", file=report)
+    
+    print("\n" + "="*60, file=report)
+    print("ANALYSIS COMPLETE", file=report)
+    print("="*60, file=report)
+    print("\nNOTE: For publication, re-run analyses in R using the `survey` package", file=report)
+    print("or SAS PROC SURVEY procedures for proper variance estimation.", file=report)
+    
+    sys.stdout.write(report.getvalue())
 
 
 if __name__ == "__main__":
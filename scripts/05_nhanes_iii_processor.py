@@ -4,9 +4,15 @@ Downloads and converts ASCII DAT files to parquet format
 """
 
 import os
+import re
+import mmap
+import shutil
 import requests
+import numpy as np
 import pandas as pd
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
 
 # Disable SSL warnings
 import urllib3
@@ -19,6 +25,21 @@ HEADERS = {
     'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36',
 }
 
+# Read/write size when streaming a response to disk
+CHUNK_SIZE = 1 << 20
+
+# INPUT statement entries: @col varname $length. or @col varname length.
+SAS_INPUT_RE = re.compile(rb'@(\d+)\s+(\w+)\s+\$?(\d+)\.')
+
+# The DAT/SAS files are independent downloads from one host - fetch them together
+MAX_WORKERS = 6
+
+# Pooled session so the concurrent downloads reuse connections to wwwn.cdc.gov
+SESSION = requests.Session()
+SESSION.headers.update(HEADERS)
+SESSION.verify = False
+SESSION.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=MAX_WORKERS))
+
 # NHANES III files - ASCII DAT format with SAS code for reading
 NHANES_III_FILES = {
     "adult": {
@@ -72,15 +93,22 @@ def download_file(url: str, dest_path: Path) -> bool:
             return True
             
         print(f"  [DOWNLOADING] {url.split('/')[-1]}...")
-        response = requests.get(url, headers=HEADERS, verify=False, timeout=120)
+        tmp_path = dest_path.with_name(dest_path.name + ".part")
+        size = 0
+        with SESSION.get(url, timeout=120, stream=True) as response:
+            if response.status_code == 200:
+                response.raw.decode_content = True
+                with open(tmp_path, 'wb') as f:
+                    shutil.copyfileobj(response.raw, f, length=CHUNK_SIZE)
+                size = tmp_path.stat().st_size
         
-        if response.status_code == 200 and len(response.content) > 1000:
-            with open(dest_path, 'wb') as f:
-                f.write(response.content)
-            print(f"  [SUCCESS] {dest_path.name} ({len(response.content):,} bytes)")
+        if size > 1000:
+            tmp_path.replace(dest_path)
+            print(f"  [SUCCESS] {dest_path.name} ({size:,} bytes)")
             return True
         else:
-            print(f"  [FAILED] Got {len(response.content)} bytes")
+            tmp_path.unlink(missing_ok=True)
+            print(f"  [FAILED] Got {size} bytes")
             return False
     except Exception as e:
         print(f"  [ERROR] {e}")
@@ -95,11 +123,14 @@ def download_nhanes_iii():
     
     DATA_RAW.mkdir(parents=True, exist_ok=True)
     
-    for name, files in NHANES_III_FILES.items():
-        print(f"\n[{name}]")
-        for ext, url in files.items():
-            dest_path = DATA_RAW / f"{name}.{ext}"
-            download_file(url, dest_path)
+    tasks = [(url, DATA_RAW / f"{name}.{ext}")
+             for name, files in NHANES_III_FILES.items()
+             for ext, url in files.items()]
+    
+    print(f"\n[Downloading {len(tasks)} files, {MAX_WORKERS} at a time]")
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        results = list(executor.map(lambda task: download_file(*task), tasks))
+    print(f"\n  {sum(results)}/{len(results)} files available")
 
 
 def parse_sas_input(sas_file: Path) -> dict:
@@ -108,29 +139,65 @@ def parse_sas_input(sas_file: Path) -> dict:
     Returns dict of {varname: (start_col, length)}
     """
     variables = {}
-    with open(sas_file, 'r') as f:
-        content = f.read()
-        
-    # Look for INPUT statement
-    # Format: @col varname $length. or @col varname length.
-    import re
-    pattern = r'@(\d+)\s+(\w+)\s+\$?(\d+)\.'
-    matches = re.findall(pattern, content)
+    if sas_file.stat().st_size == 0:
+        return variables
     
-    for col, var, length in matches:
-        variables[var.upper()] = (int(col), int(length))
+    # Scan the memory-mapped file in place rather than reading it into a str
+    with open(sas_file, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as content:
+        for match in SAS_INPUT_RE.finditer(content):
+            col, var, length = match.groups()
+            variables[var.decode('ascii').upper()] = (int(col), int(length))
     
     return variables
 
 
+def parse_field(field: np.ndarray) -> np.ndarray:
+    """
+    Convert one fixed-width field (an array of raw byte strings) the way read_fwf
+    would: numbers where every non-blank value parses, blanks as NaN, int64 when
+    nothing is missing or fractional, otherwise latin1 text.
+    """
+    values = np.char.strip(field)
+    blank = values == b''
+    try:
+        numbers = np.where(blank, b'nan', values).astype(np.float64)
+    except ValueError:
+        text = np.char.decode(values, 'latin1').astype(object)
+        text[blank] = np.nan
+        return text
+    if not blank.any() and np.array_equal(numbers, np.floor(numbers)):
+        return numbers.astype(np.int64)
+    return numbers
+
+
 def read_fixed_width(dat_file: Path, var_positions: dict) -> pd.DataFrame:
     """Read fixed-width ASCII file using position specifications."""
     colspecs = [(pos-1, pos-1+length) for pos, length in var_positions.values()]
     names = list(var_positions.keys())
     
     try:
-        df = pd.read_fwf(dat_file, colspecs=colspecs, names=names, encoding='latin1')
-        return df
+        # View the file as a (records, record length) byte matrix and slice each field out of it.
+        # Trailing blank lines are dropped and a last record without a newline is space-padded.
+        data = dat_file.read_bytes()
+        size = len(data)
+        while size and data[size - 1] <= ord(' '):
+            size -= 1
+        reclen = data.find(b'\n', 0, size) + 1 or size + 1
+        pad = -(size + 1) % reclen
+        records = np.concatenate([
+            np.frombuffer(data, dtype=np.uint8, count=size),
+            np.full(pad, ord(' '), dtype=np.uint8),
+            np.array([ord('\n')], dtype=np.uint8),
+        ]).reshape(-1, reclen)
+        
+        if not (records[:, -1] == ord('\n')).all() or max(stop for _, stop in colspecs) > reclen:
+            # Ragged lines - not a true fixed-width layout
+            return pd.read_fwf(dat_file, colspecs=colspecs, names=names, encoding='latin1')
+        
+        return pd.DataFrame({
+            name: parse_field(np.ascontiguousarray(records[:, start:stop]).view(f'S{stop - start}').ravel())
+            for name, (start, stop) in zip(names, colspecs)
+        })
     except Exception as e:
         print(f"Error reading {dat_file}: {e}")
         return pd.DataFrame()
@@ -3,9 +3,13 @@ NHANES III (1988-1994) Data Processor
 Reads fixed-width ASCII files using known column positions
 """
 
+import sys
 import pandas as pd
 import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
 
 PROJECT_ROOT = Path(__file__).parent.parent
 DATA_RAW = PROJECT_ROOT / "data" / "raw" / "NHANES_III"
@@ -29,17 +33,150 @@ NHANES_III_ADULT_VARS = {
     "HAR3":     (1712, 1712), # Do you smoke now
 }
 
+# 0-indexed field byte ranges, and the layout of the packed block read_nhanes_iii_adult
+# gathers them into: every field's bytes side by side, field k at FIELD_OFFSETS[k:k+2]
+FIELD_NAMES = tuple(NHANES_III_ADULT_VARS)
+FIELD_COLSPECS = tuple((start - 1, end) for start, end in NHANES_III_ADULT_VARS.values())
+FIELD_BYTE_INDEX = np.concatenate([np.arange(start, end) for start, end in FIELD_COLSPECS])
+FIELD_OFFSETS = np.cumsum([0] + [end - start for start, end in FIELD_COLSPECS])
+FIELD_WIDTHS = np.diff(FIELD_OFFSETS)
+
+# DMARETHN -> RIDRETH1 recode as a lookup table indexed by the NHANES III code (0 = unmapped)
+RACE_RECODE = {1: 3, 2: 4, 3: 1, 4: 5}
+RACE_LUT = np.zeros(max(RACE_RECODE) + 1, dtype=np.int8)
+RACE_LUT[list(RACE_RECODE)] = list(RACE_RECODE.values())
+
+# Shared dtypes for the 35-year dataset; both eras' subsets are cast to these before they are written
+FULL_DATASET_DTYPES = {
+    "SEQN": "Int32",
+    "RIDAGEYR": "Int8",
+    "RIAGENDR": "Int8",
+    "RIDRETH1": "Int8",
+    "INDFMPIR": "float64",  # PIR and survey weights stay float64, as in 02, for weighted sums
+    "WTMEC2YR": "float64",
+    "SDMVSTRA": "Int16",
+    "SDMVPSU": "Int8",
+    "chd_composite": "Int8",
+}
+
+# Rows per parquet row group / write batch
+ROW_GROUP_SIZE = 65536
+
+
+def to_common_schema(df: pd.DataFrame, categories: dict) -> pd.DataFrame:
+    """Cast a subset to FULL_DATASET_DTYPES, with shared categories for the label columns."""
+    dtypes = {col: dtype for col, dtype in FULL_DATASET_DTYPES.items() if col in df.columns}
+    dtypes.update({col: pd.CategoricalDtype(cats) for col, cats in categories.items() if col in df.columns})
+    return df.astype(dtypes)
+
+
+def write_parquet(frames, path: Path, after=None):
+    """
+    Write frames that share one schema to a single zstd parquet file, in
+    ROW_GROUP_SIZE-row batches through one ParquetWriter. frames may be a
+    generator, so only one frame needs to be in memory at a time.
+    
+    The file is written to path + ".part" and only replaced onto path once
+    every frame is written and the writer is closed, so a failure part-way
+    never leaves a valid-looking file with missing rows at path. If after
+    is a Future (e.g. the write of an input), it must succeed first.
+    """
+    tmp_path = path.with_name(path.name + ".part")
+    writer = None
+    try:
+        for frame in frames:
+            table = pa.Table.from_pandas(frame, preserve_index=False)
+            if writer is None:
+                schema = table.schema
+                writer = pq.ParquetWriter(tmp_path, schema, compression='zstd', compression_level=3)
+            table = table.cast(schema)
+            for start in range(0, table.num_rows, ROW_GROUP_SIZE):
+                writer.write_table(table.slice(start, ROW_GROUP_SIZE))
+        if writer is not None:
+            writer.close()
+            writer = None
+            if after is not None:
+                after.result()
+            tmp_path.replace(path)
+    finally:
+        if writer is not None:
+            writer.close()
+        tmp_path.unlink(missing_ok=True)
+
+
+def is_up_to_date(output: Path, *sources: Path) -> bool:
+    """
+    True if output is a complete parquet file newer than every source and
+    this script (e.g. a recode edit), so re-running can skip rebuilding it.
+    Outputs only reach their final path through write_parquet's atomic
+    replace; an unreadable footer (e.g. a copy interrupted by hand) is stale.
+    """
+    if not output.exists():
+        return False
+    source_mtime = max(path.stat().st_mtime for path in (*sources, Path(__file__)))
+    if output.stat().st_mtime <= source_mtime:
+        return False
+    try:
+        pq.read_metadata(output)
+    except (OSError, pa.ArrowInvalid):
+        return False
+    return True
+
 
 def read_nhanes_iii_adult(dat_file: Path) -> pd.DataFrame:
     """Read NHANES III adult file using fixed-width format."""
     print(f"[Reading {dat_file.name}...]")
     
-    # Convert to 0-indexed colspecs for pandas
-    colspecs = [(v[0]-1, v[1]) for v in NHANES_III_ADULT_VARS.values()]
-    names = list(NHANES_III_ADULT_VARS.keys())
-    
     try:
-        df = pd.read_fwf(dat_file, colspecs=colspecs, names=names, encoding='latin1')
+        # Records are fixed length: memory-map the file as a (records, record length) byte
+        # matrix so only the field byte ranges are copied out. Trailing blank lines and EOF
+        # bytes are dropped; the last record, left without its newline, is read on its own
+        # and space-padded to full length.
+        data = np.memmap(dat_file, dtype=np.uint8, mode='r')
+        size = len(data)
+        while size and data[size - 1] <= ord(' '):
+            size -= 1
+        with open(dat_file, 'rb') as f:
+            first = f.readline()
+        reclen = len(first) if first.endswith(b'\n') and len(first) <= size else size + 1
+        n_full, rest = divmod(size, reclen)
+        records = data[:n_full * reclen].reshape(n_full, reclen)
+        last = data[n_full * reclen:size]
+        
+        if (not (records[:, -1] == ord('\n')).all() or (last == ord('\n')).any()
+                or FIELD_BYTE_INDEX.max() >= reclen - 1):
+            # Ragged lines - not a true fixed-width layout
+            df = pd.read_fwf(dat_file, colspecs=list(FIELD_COLSPECS), names=list(FIELD_NAMES),
+                             encoding='latin1')
+            # Same dtypes as the fast path: single-digit fields as nullable Int8
+            df = df.astype({name: "Int8" for name, width in zip(FIELD_NAMES, FIELD_WIDTHS) if width == 1})
+            print(f"  Loaded {len(df):,} participants")
+            return df
+        
+        tail = np.full((1 if rest else 0, reclen), ord(' '), dtype=np.uint8)
+        tail[:, :rest] = last
+        
+        # Gather every field's bytes in one pass over the mapping into a packed
+        # (records, total field width) block; fields are then contiguous column ranges of it
+        packed = np.concatenate([records[:, FIELD_BYTE_INDEX], tail[:, FIELD_BYTE_INDEX]])
+        
+        def field(k):
+            """Field k's bytes for every record, as stripped latin1 strings."""
+            start, end = FIELD_OFFSETS[k], FIELD_OFFSETS[k + 1]
+            raw = np.ascontiguousarray(packed[:, start:end])
+            return np.char.decode(np.char.strip(raw.view(f'S{end - start}').ravel()), 'latin1')
+        
+        def digit(k):
+            """Single-byte field k as a nullable Int8 straight from the ASCII digit."""
+            codes = packed[:, FIELD_OFFSETS[k]] - np.uint8(ord('0'))
+            # Blanks and other non-digits wrap around above 9
+            return pd.arrays.IntegerArray(codes.astype(np.int8), codes > 9)
+        
+        # Blank fields become NaN
+        df = pd.DataFrame({
+            name: digit(k) if FIELD_WIDTHS[k] == 1 else pd.to_numeric(field(k), errors='coerce')
+            for k, name in enumerate(FIELD_NAMES)
+        })
         print(f"  Loaded {len(df):,} participants")
         return df
     except Exception as e:
@@ -51,8 +188,8 @@ def harmonize_nhanes_iii(df: pd.DataFrame) -> pd.DataFrame:
     """Harmonize NHANES III variables to match Continuous NHANES."""
     print("[Harmonizing variables...]")
     
-    # Rename to match Continuous NHANES
-    df = df.rename(columns={
+    # Rename to match Continuous NHANES (in place - only the column labels change)
+    df.rename(columns={
         "SEQN": "SEQN",
         "HSAGEIR": "RIDAGEYR",
         "HSSEX": "RIAGENDR",
@@ -61,26 +198,29 @@ def harmonize_nhanes_iii(df: pd.DataFrame) -> pd.DataFrame:
         "WTPFEX6": "WTMEC2YR",
         "SDPSTRA6": "SDMVSTRA",
         "SDPPSU6": "SDMVPSU",
-    })
+    }, inplace=True)
     
     # Recode race/ethnicity to match Continuous NHANES
     # NHANES III: 1=NH White, 2=NH Black, 3=Mexican American, 4=Other
     # Continuous: 1=Mexican American, 2=Other Hispanic, 3=NH White, 4=NH Black, 5=Other
-    race_recode = {1: 3, 2: 4, 3: 1, 4: 5}
-    df["RIDRETH1"] = df["RIDRETH1"].map(race_recode)
+    # Gather through RACE_LUT; unmapped or missing codes land on 0 and become <NA>
+    codes = df["RIDRETH1"].fillna(0).to_numpy(dtype=np.int64)
+    recoded = RACE_LUT[np.where((codes > 0) & (codes < len(RACE_LUT)), codes, 0)]
+    df["RIDRETH1"] = pd.arrays.IntegerArray(recoded, recoded == 0)
     
     # Create CHD composite outcome
     # HAD1=CHD, HAD2=angina, HAD3=heart attack
     # 1=Yes, 2=No in NHANES coding
-    df["chd_composite"] = np.nan
-    any_yes = (df["HAD1"] == 1) | (df["HAD2"] == 1) | (df["HAD3"] == 1)
-    all_no = (df["HAD1"] == 2) & (df["HAD2"] == 2) & (df["HAD3"] == 2)
-    df.loc[any_yes, "chd_composite"] = 1
-    df.loc[all_no, "chd_composite"] = 0
+    # 1 if any is 1 (Yes), 0 if all are 2 (No), NaN otherwise - one pass over a stacked (n, 3) block
+    had = df[["HAD1", "HAD2", "HAD3"]].to_numpy(dtype=np.int8, na_value=0)
+    any_yes = (had == 1).any(axis=1)
+    all_no = (had == 2).all(axis=1)
+    df["chd_composite"] = np.select([any_yes, all_no], [np.float32(1), np.float32(0)], default=np.float32(np.nan))
     
-    # Add era and cycle info
-    df["era"] = "Era1_1988-1994"
-    df["cycle"] = "1988-1994"
+    # Add era and cycle info - single-category labels stored as int8 codes
+    codes = np.zeros(len(df), dtype=np.int8)
+    df["era"] = pd.Categorical.from_codes(codes, categories=["Era1_1988-1994"])
+    df["cycle"] = pd.Categorical.from_codes(codes, categories=["1988-1994"])
     
     return df
 
@@ -98,48 +238,120 @@ def main():
         print("Run 05_nhanes_iii_processor.py first to download.")
         return
     
-    # Read adult file
-    df = read_nhanes_iii_adult(adult_dat)
-    
-    if len(df) == 0:
-        print("[ERROR] No data loaded")
-        return
-    
-    # Harmonize variables
-    df = harmonize_nhanes_iii(df)
-    
-    # Save processed NHANES III
     DATA_PROCESSED.mkdir(parents=True, exist_ok=True)
     output_path = DATA_PROCESSED / "nhanes3_harmonized.parquet"
-    df.to_parquet(output_path)
-    print(f"\n[Saved] {output_path}")
-    print(f"Total: {len(df):,} participants")
-    print(f"CHD cases: {int(df['chd_composite'].sum()):,}")
+    
+    if is_up_to_date(output_path, adult_dat):
+        print(f"\n[Up-to-date] {output_path} - skipping")
+        df = None
+        nhanes3_write = None
+    else:
+        # Read adult file
+        df = read_nhanes_iii_adult(adult_dat)
+        
+        if len(df) == 0:
+            print("[ERROR] No data loaded")
+            return
+        
+        # Harmonize variables
+        df = harmonize_nhanes_iii(df)
+        
+        # Narrow to the shared dtypes; the raw HAD/HAR answers are single-digit codes
+        df = to_common_schema(df, {}).astype({col: "Int8" for col in ("HAD1", "HAD2", "HAD3", "HAR1", "HAR3")})
+        
+        # Save processed NHANES III in the background; pyarrow releases the GIL while
+        # encoding, so the write overlaps with the merge below
+        writer_pool = ThreadPoolExecutor(max_workers=1)
+        nhanes3_write = writer_pool.submit(write_parquet, [df], output_path)
+        writer_pool.shutdown(wait=False)
+        print(f"\nTotal: {len(df):,} participants")
+        print(f"CHD cases: {np.count_nonzero(df['chd_composite'].to_numpy(dtype=np.int8, na_value=0)):,}")
     
     # Also append to main dataset
     print("\n[Merging with Continuous NHANES...]")
     main_data = DATA_PROCESSED / "nhanes_chd_harmonized.parquet"
     
-    if main_data.exists():
-        combined_df = pd.read_parquet(main_data)
-        
+    full_output = DATA_PROCESSED / "nhanes_chd_full_35year.parquet"
+    full_rejected = False
+    
+    # A freshly rebuilt NHANES III file always makes the full dataset stale
+    if main_data.exists() and df is None and is_up_to_date(full_output, main_data, output_path):
+        print(f"[Up-to-date] {full_output} - skipping")
+    elif main_data.exists():
         # Ensure consistent columns
         common_cols = ['SEQN', 'RIDAGEYR', 'RIAGENDR', 'RIDRETH1', 'INDFMPIR',
                        'WTMEC2YR', 'SDMVSTRA', 'SDMVPSU', 'chd_composite', 
                        'era', 'cycle']
         
+        if df is None:
+            df = pd.read_parquet(output_path, columns=common_cols)
+        
+        # Only the shared columns of the Continuous NHANES file are decoded, one
+        # record batch at a time; its keys and labels are read up front for validation
+        # and the shared categories
+        main_file = pq.ParquetFile(main_data)
+        main_cols = [c for c in common_cols if c in main_file.schema_arrow.names]
+        main_keys = pd.read_parquet(main_data, columns=['SEQN', 'era', 'cycle'])
         df_subset = df[[c for c in common_cols if c in df.columns]]
-        combined_subset = combined_df[[c for c in common_cols if c in combined_df.columns]]
         
-        # Combine
-        full_data = pd.concat([df_subset, combined_subset], ignore_index=True)
+        # One schema for both eras (era/cycle share their categories), so every
+        # batch lands in the file with identical types and category codes
+        categories = {
+            col: pd.Index(sorted(set(df_subset[col].dropna().unique()) | set(main_keys[col].dropna().unique())))
+            for col in ('era', 'cycle')
+        }
+        
+        # Era codes under the shared categories; era may be stored as plain strings
+        # (files from older 02 runs), and a missing era gets code -1
+        era_categories = categories['era']
+        era_codes = [
+            era_categories.get_indexer(part['era'])
+            for part in (df_subset, main_keys)
+        ]
+        n_missing_era = sum(int(np.count_nonzero(codes < 0)) for codes in era_codes)
+        n_missing_seqn = sum(int(part['SEQN'].isna().sum()) for part in (df_subset, main_keys))
         
-        # Save full dataset
-        full_output = DATA_PROCESSED / "nhanes_chd_full_35year.parquet"
-        full_data.to_parquet(full_output)
-        print(f"\n[Saved Full Dataset] {full_output}")
-        print(f"Total participants: {len(full_data):,}")
-        print(f"Eras: {full_data['era'].value_counts().to_dict()}")
+        # SEQN is only unique within an era: pack (era code, SEQN) into one uint64 key
+        # (era in the high 32 bits) so duplicates are found with a flat hash
+        n_duplicates = 0
+        if not (n_missing_era or n_missing_seqn):
+            keys = np.concatenate([
+                (codes.astype(np.uint64) << np.uint64(32)) | part['SEQN'].to_numpy(dtype=np.uint64)
+                for codes, part in zip(era_codes, (df_subset, main_keys))
+            ])
+            n_duplicates = len(keys) - len(pd.unique(keys))
+        
+        def full_dataset_batches():
+            yield to_common_schema(df_subset, categories)
+            for batch in main_file.iter_batches(batch_size=ROW_GROUP_SIZE, columns=main_cols):
+                yield to_common_schema(batch.to_pandas(), categories)
+        
+        if n_missing_era or n_missing_seqn or n_duplicates:
+            if n_missing_era:
+                print(f"[ERROR] {n_missing_era:,} rows without an era")
+            if n_missing_seqn:
+                print(f"[ERROR] {n_missing_seqn:,} rows without a SEQN")
+            if n_duplicates:
+                print(f"[ERROR] {n_duplicates:,} duplicate (era, SEQN) keys")
+            print("[ERROR] Full dataset not written")
+            full_rejected = True
+        else:
+            # Save full dataset - streamed, the combined table is never held in memory. It is
+            # only published once the background NHANES III write has succeeded, so it is never
+            # newer than a missing or stale input
+            write_parquet(full_dataset_batches(), full_output, after=nhanes3_write)
+            print(f"\n[Saved Full Dataset] {full_output}")
+            print(f"Total participants: {len(keys):,}")
+            # Era counts straight from the shared category codes, in era order
+            era_counts = sum(np.bincount(codes, minlength=len(era_categories)) for codes in era_codes)
+            print(f"Eras: {dict(zip(era_categories, era_counts.tolist()))}")
+    
+    if nhanes3_write is not None:
+        nhanes3_write.result()
+        print(f"\n[Saved] {output_path}")
+    
+    if full_rejected:
+        sys.exit(1)
     
     print("\n" + "="*60)
     print("NHANES III PROCESSING COMPLETE")